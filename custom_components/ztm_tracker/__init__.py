@@ -1,5 +1,6 @@
 """The ZTM Tracker custom component."""
 import asyncio
+import functools
 import logging
 from datetime import timedelta, datetime
 import math
@@ -7,14 +8,17 @@ import zoneinfo # For timezone handling (Python 3.9+)
 
 import aiohttp
 import async_timeout
+import voluptuous as vol
 
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.const import CONF_RADIUS, STATE_UNAVAILABLE
-from homeassistant.core import HomeAssistant, State
+from homeassistant.const import CONF_RADIUS, EVENT_HOMEASSISTANT_STOP, STATE_UNAVAILABLE
+from homeassistant.core import Event, HomeAssistant, ServiceCall, State, SupportsResponse
 from homeassistant.exceptions import ConfigEntryNotReady
 from homeassistant.helpers.event import async_track_state_change, async_track_time_interval
 from homeassistant.helpers.update_coordinator import DataUpdateCoordinator, UpdateFailed
 from homeassistant.helpers import aiohttp_client
+import homeassistant.helpers.config_validation as cv
+from homeassistant.util import dt as dt_util
 
 from .const import (
     DOMAIN,
@@ -32,7 +36,20 @@ from .const import (
     DEFAULT_AUTOMATIC_INTERVAL,
     DEFAULT_GPS_TIME_OFFSET,
     DEFAULT_LINES_WHITELIST,
+    HISTORY_DB_FILE,
+    DATA_HISTORY,
+    DEFAULT_HISTORY_DAYS,
+    DEFAULT_HISTORY_LIMIT,
+    SERVICE_GET_RIDE_STATS,
+    ATTR_DAYS,
+    ATTR_LIMIT,
+    TRAJECTORY_WINDOW,
+    TRAJECTORY_CANDIDATE_FACTOR,
+    TRAJECTORY_MAX_CANDIDATES,
+    TRAJECTORY_MIN_SAMPLES,
 )
+from .history import ZTMRideHistory
+from .trajectory import ZTMTrajectoryTracker
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -46,26 +63,63 @@ except zoneinfo.ZoneInfoNotFoundError:
     _LOGGER.error("Timezone 'Europe/Warsaw' not found. This might be a problem with the system's timezone data.")
     CET_TIMEZONE = None
 
+# How often the cached ride statistics are refreshed when no new ride was recorded
+ROUTE_STATS_REFRESH_INTERVAL = timedelta(hours=1)
+
+GET_RIDE_STATS_SCHEMA = vol.Schema({
+    vol.Optional(CONF_DEVICE_TRACKERS): cv.entity_ids,
+    vol.Optional(ATTR_DAYS, default=DEFAULT_HISTORY_DAYS): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(ATTR_LIMIT, default=DEFAULT_HISTORY_LIMIT): vol.All(vol.Coerce(int), vol.Range(min=1)),
+})
+
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry):
     """Set up ZTM Tracker from a config entry."""
     _LOGGER.debug("Setting up ZTM Tracker component from config entry.")
     hass.data.setdefault(DOMAIN, {})
 
-    coordinator = ZTMTrackerCoordinator(hass, entry)
+    # The ride history is shared by all config entries, so a single thread owns the database
+    if DATA_HISTORY not in hass.data[DOMAIN]:
+        hass.data[DOMAIN][DATA_HISTORY] = ZTMRideHistory(hass.config.path(HISTORY_DB_FILE))
+    history: ZTMRideHistory = hass.data[DOMAIN][DATA_HISTORY]
+
+    coordinator = ZTMTrackerCoordinator(hass, entry, history)
+    history.acquire(coordinator)
 
     try:
         await coordinator.async_config_entry_first_refresh()
         await coordinator.async_init_listeners()
     except ConfigEntryNotReady as ex:
         _LOGGER.error("ZTM Tracker failed to initialize: %s", ex)
+        await coordinator.async_release_history()
         raise
     except Exception as ex:
         _LOGGER.error("ZTM Tracker failed to initialize due to unexpected error: %s", ex)
+        await coordinator.async_release_history()
         raise ConfigEntryNotReady(f"Failed to initialize ZTM Tracker: {ex}") from ex
 
     hass.data[DOMAIN][entry.entry_id] = coordinator
 
+    async def _async_handle_homeassistant_stop(event: Event):
+        """Log the rides in progress and flush the ride history on shutdown."""
+        # Stop the listeners first, so no ride ends after the history is released
+        coordinator.async_unload()
+        await coordinator.async_release_history()
+
+    # Config entries are not unloaded on shutdown, so pending rides are flushed here
+    entry.async_on_unload(
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _async_handle_homeassistant_stop)
+    )
+
+    if not hass.services.has_service(DOMAIN, SERVICE_GET_RIDE_STATS):
+        hass.services.async_register(
+            DOMAIN,
+            SERVICE_GET_RIDE_STATS,
+            functools.partial(_async_handle_get_ride_stats, hass),
+            schema=GET_RIDE_STATS_SCHEMA,
+            supports_response=SupportsResponse.ONLY,
+        )
+
     hass.async_create_task(
         hass.config_entries.async_forward_entry_setups(entry, ["sensor"])
     )
@@ -83,6 +137,9 @@ async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry):
         coordinator: ZTMTrackerCoordinator = hass.data[DOMAIN].pop(entry.entry_id)
         if coordinator:
             coordinator.async_unload()
+            await coordinator.async_release_history()
+        if not _get_coordinators(hass):
+            hass.services.async_remove(DOMAIN, SERVICE_GET_RIDE_STATS)
         _LOGGER.info("ZTM Tracker config entry unloaded.")
     return unload_ok
 
@@ -92,10 +149,43 @@ async def async_reload_entry(hass: HomeAssistant, entry: ConfigEntry):
     await async_unload_entry(hass, entry)
     hass.config_entries.async_setup(entry.entry_id)
 
+def _get_coordinators(hass: HomeAssistant):
+    """Return the coordinators of all loaded config entries."""
+    return [
+        coordinator for coordinator in hass.data.get(DOMAIN, {}).values()
+        if isinstance(coordinator, ZTMTrackerCoordinator)
+    ]
+
+async def _async_handle_get_ride_stats(hass: HomeAssistant, call: ServiceCall):
+    """Return the most frequent routes per device tracker from the ride history."""
+    requested_trackers = call.data.get(CONF_DEVICE_TRACKERS)
+    since = dt_util.utcnow() - timedelta(days=call.data[ATTR_DAYS])
+
+    trackers = {}
+    for coordinator in _get_coordinators(hass):
+        coordinator_trackers = [
+            tracker_id for tracker_id in coordinator.device_trackers
+            if requested_trackers is None or tracker_id in requested_trackers
+        ]
+        if not coordinator_trackers:
+            continue
+        route_counts = await coordinator.history.async_route_counts(
+            coordinator_trackers, since.timestamp(), call.data[ATTR_LIMIT]
+        )
+        if route_counts is None:
+            continue
+        for tracker_id, routes in route_counts.items():
+            trackers[tracker_id] = [{'route': route, 'rides': rides} for route, rides in routes]
+
+    return {
+        'since': since.isoformat(),
+        'trackers': trackers,
+    }
+
 class ZTMTrackerCoordinator(DataUpdateCoordinator):
     """My custom coordinator for the ZTM Tracker."""
 
-    def __init__(self, hass, config_entry):
+    def __init__(self, hass, config_entry, history):
         """Initialize my coordinator."""
         self.config_entry = config_entry
         self.hass = hass
@@ -114,6 +204,20 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
         self._last_route_seen = {}
         self._event_data = {}
 
+        # Ride history log and cached statistics for the sensors
+        self.history = history
+        self._history_released = False
+        self._route_stats = {}
+        self._route_stats_updated = None
+        self._route_stats_failed = None
+        self._rides_recorded = False
+
+        # Recent positions of trackers and nearby vehicles for co-movement matching
+        # Co-movement needs at least two positions for a heading, but never more than shots_in
+        self._trajectories = ZTMTrajectoryTracker(
+            TRAJECTORY_WINDOW, self.radius, max(2, min(TRAJECTORY_MIN_SAMPLES, self.shots_in))
+        )
+
         # Listeners for device tracker state changes
         self._listeners = []
         self._state_change_listener_handles = []
@@ -137,6 +241,15 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
             self._time_listener_handle()
             self._time_listener_handle = None
 
+    async def async_release_history(self):
+        """Log the confirmed rides in progress and release the shared ride history."""
+        if self._history_released:
+            return
+        self._history_released = True
+        for tracker_id, event in self._event_data.items():
+            self._record_ride(tracker_id, event)
+        await self.history.async_release(self)
+
     def get_current_events(self):
         """Return the current events data."""
         return self._event_data
@@ -145,6 +258,10 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
         """Return the last seen route for a given device tracker."""
         return self._last_route_seen.get(device_tracker_id, "Unknown")
 
+    def get_route_stats(self, device_tracker_id):
+        """Return the most frequent routes of the last days for a given device tracker."""
+        return self._route_stats.get(device_tracker_id, [])
+
     async def async_init_listeners(self):
         """Set up all listeners."""
         _LOGGER.debug("Initializing listeners.")
@@ -194,7 +311,17 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
         longitude = new_state.attributes.get('longitude')
 
         if latitude is not None and longitude is not None:
-            self._tracker_locations[entity_id] = {'latitude': latitude, 'longitude': longitude}
+            # Attribute-only updates (battery, accuracy) keep the time of the last real fix
+            previous_location = self._tracker_locations.get(entity_id)
+            if previous_location and previous_location['latitude'] == latitude and previous_location['longitude'] == longitude:
+                timestamp = previous_location['timestamp']
+            else:
+                timestamp = new_state.last_updated.timestamp()
+            self._tracker_locations[entity_id] = {
+                'latitude': latitude,
+                'longitude': longitude,
+                'timestamp': timestamp,
+            }
             _LOGGER.debug("Location updated for %s: %s", entity_id, self._tracker_locations[entity_id])
             await self.async_request_refresh()
         else:
@@ -216,6 +343,9 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
         
         # Then, process events based on tracker locations and vehicle data
         self._async_process_events()
+
+        # Refresh the ride statistics if the history changed
+        await self._async_refresh_route_stats()
         
         # Return event data for the coordinator's use
         return self._event_data
@@ -246,9 +376,79 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
         except Exception as err:
             raise UpdateFailed(f"Unexpected error while fetching data: {err}") from err
 
+    async def _async_refresh_route_stats(self):
+        """Refresh the cached ride statistics after new rides or once the cache is stale."""
+        now = dt_util.utcnow()
+        if self._route_stats_failed is not None and now - self._route_stats_failed < ROUTE_STATS_REFRESH_INTERVAL:
+            return
+        if (
+            not self._rides_recorded
+            and self._route_stats_updated is not None
+            and now - self._route_stats_updated < ROUTE_STATS_REFRESH_INTERVAL
+        ):
+            return
+
+        since = now - timedelta(days=DEFAULT_HISTORY_DAYS)
+        try:
+            route_stats = await self.history.async_route_counts(
+                self.device_trackers, since.timestamp(), DEFAULT_HISTORY_LIMIT
+            )
+        except Exception as err:
+            _LOGGER.warning("Could not query the ride history, retrying in %s: %s", ROUTE_STATS_REFRESH_INTERVAL, err)
+            self._route_stats_failed = now
+            return
+        if route_stats is None:
+            # The history was released (shutdown or unload), keep the cached statistics
+            return
+        self._route_stats = route_stats
+        self._route_stats_failed = None
+        self._route_stats_updated = now
+        self._rides_recorded = False
+
+    def _record_ride(self, tracker_id, event):
+        """Queue a finished event in the ride history if it was confirmed by shots_in."""
+        if event.get('shots_in', 0) < self.shots_in or event.get('start_time') is None:
+            _LOGGER.debug("Event for tracker %s was not confirmed, not recording the ride.", tracker_id)
+            return
+        self.history.record_ride(
+            tracker_id,
+            event.get('vehicle'),
+            event.get('route'),
+            event['start_time'].timestamp(),
+            event['last_seen'].timestamp(),
+            event.get('min_distance'),
+        )
+        self._rides_recorded = True
+        _LOGGER.debug("Ride of tracker %s on route %s queued for the ride history.", tracker_id, event.get('route'))
+
     def _async_process_events(self):
         """Process events based on vehicle and device tracker data."""
         new_event_data = {}
+        now = dt_util.utcnow()
+
+        # Find the closest and the candidate vehicles for every tracker first,
+        # so the trajectories are extended once per cycle
+        nearby_vehicles = {}
+        candidate_positions = {}
+        for tracker_id, tracker_location in self._tracker_locations.items():
+            candidates = []
+            closest_vehicle = self._find_closest_vehicle(tracker_location, candidates)
+            distance_to_closest = closest_vehicle.get('distance') if closest_vehicle else None
+            nearby_vehicles[tracker_id] = (closest_vehicle, distance_to_closest, candidates)
+            for _, vehicle in candidates:
+                vehicle_timestamp = self._vehicle_timestamp(vehicle)
+                if vehicle_timestamp is not None:
+                    candidate_positions[vehicle.get('vehicleId')] = (vehicle_timestamp, vehicle.get('lat'), vehicle.get('lon'))
+
+        # Samples are stamped with the time the position was taken, not the poll time
+        self._trajectories.update(
+            {
+                tracker_id: (tracker_location['timestamp'], tracker_location['latitude'], tracker_location['longitude'])
+                for tracker_id, tracker_location in self._tracker_locations.items()
+            },
+            candidate_positions,
+        )
+
         for tracker_id, tracker_location in self._tracker_locations.items():
             _LOGGER.debug("Processing events for tracker %s at location %s.", tracker_id, tracker_location)
             
@@ -256,16 +456,29 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
             tracker_state = self.hass.states.get(tracker_id)
             tracker_name = tracker_state.name if tracker_state and tracker_state.name else tracker_id
             
-            # Find the closest vehicle for this tracker
-            closest_vehicle = self._find_closest_vehicle(tracker_location)
-            
+            closest_vehicle, distance_to_closest, candidates = nearby_vehicles[tracker_id]
+
+            # Prefer a vehicle the tracker has been moving together with over the closest one
+            co_moving_id = self._trajectories.best_match(tracker_id, [vehicle.get('vehicleId') for _, vehicle in candidates])
+            co_moving = co_moving_id is not None
+            if co_moving:
+                distance_to_closest, closest_vehicle = next(
+                    (distance, vehicle) for distance, vehicle in candidates if vehicle.get('vehicleId') == co_moving_id
+                )
+                _LOGGER.info("Tracker %s is moving together with vehicle %s.", tracker_id, co_moving_id)
+
             if closest_vehicle:
+                # Use a copy, the same vehicle can be near several trackers
+                closest_vehicle = {**closest_vehicle, 'distance': distance_to_closest}
                 vehicle_id = closest_vehicle.get('vehicleId')
                 distance_to_vehicle = closest_vehicle.get('distance')
                 
-                # Check for "shots in" condition
-                if distance_to_vehicle <= self.radius:
-                    _LOGGER.info("Vehicle %s is within radius for tracker %s.", vehicle_id, tracker_id)
+                # Check for "shots in" condition, co-movement over the window confirms the ride at once
+                if distance_to_vehicle <= self.radius or co_moving:
+                    if distance_to_vehicle <= self.radius:
+                        _LOGGER.info("Vehicle %s is within radius for tracker %s.", vehicle_id, tracker_id)
+                    else:
+                        _LOGGER.info("Vehicle %s is outside radius (%.0fm) but co-moving with tracker %s.", vehicle_id, distance_to_vehicle, tracker_id)
                     
                     # Update the last seen route immediately upon detection
                     route = closest_vehicle.get('routeShortName', 'Unknown')
@@ -278,21 +491,36 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
                     if self._event_data.get(tracker_id) and self._event_data[tracker_id].get('vehicle') == vehicle_id:
                         # Increment 'shots_in' count
                         shots_in = self._event_data[tracker_id].get('shots_in', 0) + 1
+                        if co_moving:
+                            shots_in = max(shots_in, self.shots_in)
                         _LOGGER.debug("Incrementing shots_in for tracker %s. New count: %d", tracker_id, shots_in)
                         new_event_data[tracker_id] = {
                             'vehicle': vehicle_id,
+                            'route': route,
                             'shots_in': shots_in,
                             'shots_out': 0, # Reset shots_out
+                            'co_moving': co_moving,
+                            'start_time': self._event_data[tracker_id].get('start_time', now),
+                            'last_seen': now,
+                            'min_distance': min(self._event_data[tracker_id].get('min_distance', distance_to_vehicle), distance_to_vehicle),
                             'ztm_vehicle': closest_vehicle, # Keep a reference to the vehicle data
                             'event_summary': f"Tracker {tracker_name} is near route {route}"
                         }
                     else:
+                        # A different vehicle replaces the previous one, which ends its ride
+                        if self._event_data.get(tracker_id):
+                            self._record_ride(tracker_id, self._event_data[tracker_id])
                         # First time seeing this vehicle, create a new event
                         _LOGGER.info("New vehicle %s detected within radius for tracker %s.", vehicle_id, tracker_id)
                         new_event_data[tracker_id] = {
                             'vehicle': vehicle_id,
-                            'shots_in': 1,
+                            'route': route,
+                            'shots_in': self.shots_in if co_moving else 1,
                             'shots_out': 0,
+                            'co_moving': co_moving,
+                            'start_time': now,
+                            'last_seen': now,
+                            'min_distance': distance_to_vehicle,
                             'ztm_vehicle': closest_vehicle,
                             'event_summary': f"Tracker {tracker_name} is near route {route}"
                         }
@@ -307,15 +535,14 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
                         if shots_out < self.shots_out:
                             _LOGGER.debug("Tracker %s is moving away, but event continues.", tracker_id)
                             new_event_data[tracker_id] = {
-                                'vehicle': self._event_data[tracker_id].get('vehicle'),
-                                'shots_in': self._event_data[tracker_id].get('shots_in', 0),
+                                **self._event_data[tracker_id],
                                 'shots_out': shots_out,
-                                'ztm_vehicle': self._event_data[tracker_id].get('ztm_vehicle'),
-                                'event_summary': self._event_data[tracker_id].get('event_summary')
+                                'co_moving': False,
                             }
                         else:
                             # Event is considered ended
                             _LOGGER.info("Event ended for tracker %s. Vehicle %s is too far away.", tracker_id, self._event_data[tracker_id].get('vehicle'))
+                            self._record_ride(tracker_id, self._event_data[tracker_id])
                             # The event is not added to new_event_data, so it will be removed.
             else:
                 _LOGGER.debug("No vehicles found for tracker %s.", tracker_id)
@@ -325,22 +552,25 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
                     if shots_out < self.shots_out:
                          _LOGGER.debug("Tracker %s is far from any vehicle, but event continues.", tracker_id)
                          new_event_data[tracker_id] = {
-                            'vehicle': self._event_data[tracker_id].get('vehicle'),
-                            'shots_in': self._event_data[tracker_id].get('shots_in', 0),
+                            **self._event_data[tracker_id],
                             'shots_out': shots_out,
-                            'ztm_vehicle': self._event_data[tracker_id].get('ztm_vehicle'),
-                            'event_summary': self._event_data[tracker_id].get('event_summary')
+                            'co_moving': False,
                         }
                     else:
                         _LOGGER.info("Event ended for tracker %s. No vehicle nearby.", tracker_id)
+                        self._record_ride(tracker_id, self._event_data[tracker_id])
         
         # Update the main event data dictionary
         self._event_data = new_event_data
         _LOGGER.info("Event processing complete. Found %d active events.", len(self._event_data))
 
 
-    def _find_closest_vehicle(self, tracker_location):
-        """Find the closest vehicle to a given tracker location, respecting filters."""
+    def _find_closest_vehicle(self, tracker_location, candidates=None):
+        """Find the closest vehicle to a given tracker location, respecting filters.
+
+        If a `candidates` list is given, it is filled with (distance, vehicle) tuples
+        of the nearest vehicles worth following for co-movement matching.
+        """
         if not self._vehicle_data:
             _LOGGER.debug("No vehicle data available.")
             return None
@@ -396,10 +626,25 @@ class ZTMTrackerCoordinator(DataUpdateCoordinator):
                 closest_vehicle = vehicle
                 closest_vehicle['distance'] = distance # Add distance to the vehicle dict
 
+            if candidates is not None and distance <= self.radius * TRAJECTORY_CANDIDATE_FACTOR:
+                candidates.append((distance, vehicle))
+
+        if candidates is not None:
+            # Keep only the nearest candidates, so the followed set stays small
+            candidates.sort(key=lambda candidate: candidate[0])
+            del candidates[TRAJECTORY_MAX_CANDIDATES:]
+
         _LOGGER.debug("Closest vehicle found: %s with distance: %s", closest_vehicle.get('vehicleId') if closest_vehicle else "None", min_distance if closest_vehicle else "N/A")
         
         return closest_vehicle
 
+    def _vehicle_timestamp(self, vehicle):
+        """Return the POSIX timestamp of a vehicle's GPS position, or None if it cannot be parsed."""
+        try:
+            return datetime.fromisoformat(vehicle.get('generated').replace('Z', '+00:00')).timestamp()
+        except (AttributeError, ValueError, TypeError):
+            return None
+
     def _haversine(self, lat1, lon1, lat2, lon2):
         """
         Calculate the distance between two points on Earth using the Haversine formula.
@@ -18,3 +18,20 @@ DEFAULT_SHOTS_OUT = 3
 DEFAULT_AUTOMATIC_INTERVAL = 3  # minutes
 DEFAULT_GPS_TIME_OFFSET = 120 # Added default value for GPS time offset in seconds
 DEFAULT_LINES_WHITELIST = "2,5,12,169,171,179,6,8,11" # Added default value for lines whitelist
+
+HISTORY_DB_FILE = "ztm_tracker_history.db" # Ride history database, stored in the HA config dir
+DATA_HISTORY = "history" # hass.data[DOMAIN] key of the ride history shared by all config entries
+DEFAULT_HISTORY_DAYS = 7 # Window for ride statistics in days
+DEFAULT_HISTORY_LIMIT = 5 # Number of most frequent routes reported per tracker
+
+SERVICE_GET_RIDE_STATS = "get_ride_stats"
+ATTR_DAYS = "days"
+ATTR_LIMIT = "limit"
+
+TRAJECTORY_WINDOW = 5 # Number of recent positions kept per tracker and candidate vehicle
+TRAJECTORY_CANDIDATE_FACTOR = 4 # Vehicles within radius * factor of a tracker are followed
+TRAJECTORY_MAX_CANDIDATES = 8 # Maximum number of followed vehicles per tracker
+TRAJECTORY_MIN_SAMPLES = 3 # Matched positions needed to score co-movement, lowered to shots_in (at least 2)
+TRAJECTORY_MAX_TIME_GAP = 60 # seconds, how far vehicle positions may be extrapolated to a tracker position
+TRAJECTORY_MIN_MOVEMENT = 15 # meters, shorter steps are ignored for heading agreement
+TRAJECTORY_MIN_HEADING_AGREEMENT = 0.8 # Mean cosine between tracker and vehicle headings
@@ -0,0 +1,210 @@
+"""Ride history log for the ZTM Tracker custom component."""
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import sqlite3
+import threading
+
+_LOGGER = logging.getLogger(__name__)
+
+# Maximum number of rides kept in memory before they are written in one transaction
+HISTORY_BATCH_SIZE = 50
+# Maximum time (seconds) a ride waits in memory before the batch is flushed
+HISTORY_FLUSH_INTERVAL = 30
+
+_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS rides (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tracker TEXT NOT NULL,
+        vehicle TEXT,
+        route TEXT,
+        start_ts REAL NOT NULL,
+        end_ts REAL NOT NULL,
+        min_distance REAL
+    )
+    """,
+    # Covers the per-tracker time window queries together with the route grouping
+    "CREATE INDEX IF NOT EXISTS idx_rides_tracker_start_route ON rides (tracker, start_ts, route)",
+)
+
+_INSERT_RIDE = (
+    "INSERT INTO rides (tracker, vehicle, route, start_ts, end_ts, min_distance) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+_STOP = object()
+
+
+class ZTMRideHistory:
+    """SQLite ride log with writes batched on a dedicated background thread.
+
+    The thread owns the only connection to the database. Rides are queued by
+    the event loop and written in batches; queries are executed on the same
+    thread after flushing pending rides, so they always see every recorded ride.
+    One instance is shared by all config entries: the writer runs while at
+    least one user holds it (see `acquire` and `async_release`). Every writer
+    thread gets its own queue, so a writer started while the previous one is
+    still flushing never shares work with it. Once stopped, rides and queries
+    are skipped.
+    """
+
+    def __init__(self, db_path):
+        """Initialize the ride history."""
+        self.db_path = db_path
+        self._queue = None
+        self._thread = None
+        self._users = set()
+
+    def acquire(self, user):
+        """Register a user of the history, starting the writer thread if needed."""
+        self._users.add(user)
+        self.start()
+
+    async def async_release(self, user):
+        """Unregister a user, flushing and stopping the writer with the last one."""
+        self._users.discard(user)
+        if not self._users:
+            await self.async_stop()
+
+    def start(self):
+        """Start the writer thread."""
+        if self._thread is not None:
+            return
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, args=(self._queue,), name="ztm_tracker_history", daemon=True
+        )
+        self._thread.start()
+        _LOGGER.debug("Ride history writer started for %s.", self.db_path)
+
+    def _detach(self):
+        """Detach the running writer and ask it to stop, returning its thread or None."""
+        thread, work_queue = self._thread, self._queue
+        if thread is None:
+            return None
+        self._thread = None
+        self._queue = None
+        work_queue.put(_STOP)
+        return thread
+
+    def stop(self):
+        """Flush pending rides and stop the writer thread (blocking)."""
+        thread = self._detach()
+        if thread is not None:
+            thread.join()
+            _LOGGER.debug("Ride history writer stopped.")
+
+    async def async_stop(self):
+        """Flush pending rides and stop the writer thread."""
+        # Detach on the event loop, so an acquire() during the join starts a fresh writer
+        thread = self._detach()
+        if thread is not None:
+            await asyncio.get_running_loop().run_in_executor(None, thread.join)
+            _LOGGER.debug("Ride history writer stopped.")
+
+    def record_ride(self, tracker, vehicle, route, start_ts, end_ts, min_distance):
+        """Queue a completed ride for writing. Safe to call from the event loop."""
+        if self._queue is None:
+            _LOGGER.debug("Ride history is stopped, not recording the ride of %s.", tracker)
+            return
+        self._queue.put(
+            (tracker, str(vehicle) if vehicle is not None else None, route, start_ts, end_ts, min_distance)
+        )
+
+    async def async_route_counts(self, trackers, since_ts, limit):
+        """Return the most frequent routes per tracker since a timestamp.
+
+        The result maps each tracker to a list of ``(route, rides)`` tuples,
+        ordered from the most frequent route, or is None if the history is stopped.
+        """
+        return await self._async_submit(self._route_counts, trackers, since_ts, limit)
+
+    async def _async_submit(self, func, *args):
+        """Run a query on the writer thread and wait for its result, or return None if stopped."""
+        if self._queue is None:
+            _LOGGER.debug("Ride history is stopped, skipping the query.")
+            return None
+        future = concurrent.futures.Future()
+        self._queue.put((future, func, args))
+        return await asyncio.wrap_future(future)
+
+    def _route_counts(self, conn, trackers, since_ts, limit):
+        """Query the most frequent routes per tracker (writer thread only)."""
+        result = {}
+        for tracker in trackers:
+            rows = conn.execute(
+                "SELECT route, COUNT(*) AS rides FROM rides "
+                "WHERE tracker = ? AND start_ts >= ? "
+                "GROUP BY route ORDER BY rides DESC, route LIMIT ?",
+                (tracker, since_ts, limit),
+            ).fetchall()
+            result[tracker] = [(route, rides) for route, rides in rows]
+        return result
+
+    def _run(self, work_queue):
+        """Writer thread main loop."""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            conn.execute("PRAGMA journal_mode=WAL")
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            conn.commit()
+        except sqlite3.Error as err:
+            _LOGGER.error("Could not open ride history database %s: %s", self.db_path, err)
+            self._drain_after_failure(work_queue, err)
+            return
+
+        pending = []
+        try:
+            while True:
+                try:
+                    item = work_queue.get(timeout=HISTORY_FLUSH_INTERVAL if pending else None)
+                except queue.Empty:
+                    self._flush(conn, pending)
+                    continue
+
+                if item is _STOP:
+                    self._flush(conn, pending)
+                    break
+
+                if isinstance(item[0], concurrent.futures.Future):
+                    future, func, args = item
+                    self._flush(conn, pending)
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        future.set_result(func(conn, *args))
+                    except Exception as err:  # pylint: disable=broad-except
+                        future.set_exception(err)
+                    continue
+
+                pending.append(item)
+                if len(pending) >= HISTORY_BATCH_SIZE:
+                    self._flush(conn, pending)
+        finally:
+            conn.close()
+
+    def _flush(self, conn, pending):
+        """Write all pending rides in a single transaction."""
+        if not pending:
+            return
+        try:
+            with conn:
+                conn.executemany(_INSERT_RIDE, pending)
+            _LOGGER.debug("Wrote %d rides to the ride history.", len(pending))
+        except sqlite3.Error as err:
+            _LOGGER.error("Could not write %d rides to the ride history: %s", len(pending), err)
+        pending.clear()
+
+    def _drain_after_failure(self, work_queue, err):
+        """Fail queued queries after the database could not be opened."""
+        while True:
+            item = work_queue.get()
+            if item is _STOP:
+                return
+            if isinstance(item[0], concurrent.futures.Future):
+                future = item[0]
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(err)
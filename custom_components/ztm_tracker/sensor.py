@@ -7,7 +7,7 @@ from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
 from homeassistant.helpers.update_coordinator import CoordinatorEntity
 
-from .const import DOMAIN
+from .const import DOMAIN, DEFAULT_HISTORY_DAYS
 from . import ZTMTrackerCoordinator # Corrected import statement
 
 _LOGGER = logging.getLogger(__name__)
@@ -28,6 +28,8 @@ async def async_setup_entry(
         entities.append(ZTMTrackerEventsSensor(coordinator, config_entry, device_tracker))
         # Create the Last Route sensor for the device tracker
         entities.append(ZTMTrackerLastRouteSensor(coordinator, config_entry, device_tracker))
+        # Create the Top Route sensor for the device tracker
+        entities.append(ZTMTrackerTopRouteSensor(coordinator, config_entry, device_tracker))
 
     _LOGGER.debug("Adding %d sensor entities.", len(entities))
     async_add_entities(entities)
@@ -69,7 +71,8 @@ class ZTMTrackerEventsSensor(CoordinatorEntity, SensorEntity):
         if event and event.get('ztm_vehicle'):
             # Return a copy to prevent accidental modification
             attributes = event['ztm_vehicle'].copy()
-            attributes['distance'] = f"{event.get('distance', 0):.2f}m"
+            attributes['distance'] = f"{event['ztm_vehicle'].get('distance', 0):.2f}m"
+            attributes['co_moving'] = event.get('co_moving', False)
             _LOGGER.debug("Updating extra_state_attributes for %s: %s", self.unique_id, attributes)
             return attributes
         return {}
@@ -136,3 +139,56 @@ class ZTMTrackerLastRouteSensor(CoordinatorEntity, SensorEntity):
     def _handle_coordinator_update(self) -> None:
         """Handle updated data from the coordinator."""
         self.async_write_ha_state()
+
+
+class ZTMTrackerTopRouteSensor(CoordinatorEntity, SensorEntity):
+    """Representation of a sensor for the most frequent ZTM route from the ride history."""
+
+    def __init__(self, coordinator: ZTMTrackerCoordinator, config_entry: ConfigEntry, device_tracker_id: str) -> None:
+        """Initialize the ZTM Tracker Top Route sensor."""
+        super().__init__(coordinator)
+        self._device_tracker_id = device_tracker_id
+        self._name = f"ZTM Tracker Top Route ({device_tracker_id.split('.')[-1]})"
+        self._unique_id = f"{config_entry.entry_id}_top_route_{device_tracker_id}"
+
+    @property
+    def name(self) -> str:
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def unique_id(self) -> str:
+        """Return a unique ID for this entity."""
+        return self._unique_id
+
+    @property
+    def state(self):
+        """Return the state of the sensor."""
+        route_stats = self.coordinator.get_route_stats(self._device_tracker_id)
+        if route_stats:
+            return route_stats[0][0]
+        return None
+
+    @property
+    def extra_state_attributes(self):
+        """Return the state attributes."""
+        route_stats = self.coordinator.get_route_stats(self._device_tracker_id)
+        return {
+            'days': DEFAULT_HISTORY_DAYS,
+            'routes': {route: rides for route, rides in route_stats},
+        }
+
+    @property
+    def available(self) -> bool:
+        """Return True if the sensor is available."""
+        return self.coordinator.last_update_success
+
+    async def async_added_to_hass(self) -> None:
+        """When entity is added to Home Assistant."""
+        await super().async_added_to_hass()
+        self._handle_coordinator_update()
+
+    @callback
+    def _handle_coordinator_update(self) -> None:
+        """Handle updated data from the coordinator."""
+        self.async_write_ha_state()
@@ -0,0 +1,204 @@
+"""Trajectory co-movement matching for the ZTM Tracker custom component."""
+from array import array
+import logging
+import math
+
+from .const import (
+    TRAJECTORY_MAX_TIME_GAP,
+    TRAJECTORY_MIN_MOVEMENT,
+    TRAJECTORY_MIN_HEADING_AGREEMENT,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+# Meters per degree of latitude, used by the local equirectangular projection
+METERS_PER_DEGREE = 111320.0
+
+
+class PositionRingBuffer:
+    """Fixed-size ring buffer of timestamped positions stored in flat arrays."""
+
+    __slots__ = ("_ts", "_lat", "_lon", "_size", "_next", "_count")
+
+    def __init__(self, size):
+        """Initialize the buffer with room for `size` positions."""
+        self._ts = array('d', [0.0]) * size
+        self._lat = array('d', [0.0]) * size
+        self._lon = array('d', [0.0]) * size
+        self._size = size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        """Return the number of stored positions."""
+        return self._count
+
+    @property
+    def latest_ts(self):
+        """Return the timestamp of the newest position, or None if the buffer is empty."""
+        if not self._count:
+            return None
+        return self._ts[(self._next - 1) % self._size]
+
+    def append(self, ts, lat, lon):
+        """Store a position, overwriting the oldest one when the buffer is full."""
+        index = self._next
+        self._ts[index] = ts
+        self._lat[index] = lat
+        self._lon[index] = lon
+        self._next = (index + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+
+    def samples(self):
+        """Return the stored positions as (ts, lat, lon) tuples, oldest first."""
+        start = (self._next - self._count) % self._size
+        result = []
+        for offset in range(self._count):
+            index = (start + offset) % self._size
+            result.append((self._ts[index], self._lat[index], self._lon[index]))
+        return result
+
+
+class ZTMTrajectoryTracker:
+    """Keep recent positions of trackers and nearby vehicles and score their co-movement.
+
+    Only vehicles reported as candidates in the latest update keep a buffer, so
+    memory and work depend on the number of vehicles near trackers, not on the fleet.
+    Positions are stamped with the time they were taken, so a tracker sample is
+    compared with the vehicle position interpolated at that time.
+    """
+
+    def __init__(self, window, radius, min_samples):
+        """Initialize the trajectory tracker."""
+        self.window = window
+        self.radius = radius
+        self.min_samples = min_samples
+        self._trackers = {}
+        self._vehicles = {}
+
+    def update(self, tracker_positions, vehicle_positions):
+        """Append the positions of one polling cycle.
+
+        Both arguments map an id to a (timestamp, latitude, longitude) tuple.
+        Positions not newer than the last stored one are skipped. Buffers of
+        trackers and vehicles missing from this cycle are dropped.
+        """
+        self._trackers = self._update_buffers(self._trackers, tracker_positions)
+        self._vehicles = self._update_buffers(self._vehicles, vehicle_positions)
+        _LOGGER.debug("Trajectories updated: %d trackers, %d candidate vehicles.", len(self._trackers), len(self._vehicles))
+
+    def _update_buffers(self, buffers, positions):
+        """Append new positions to existing buffers, creating and dropping buffers as needed."""
+        updated = {}
+        for key, (ts, lat, lon) in positions.items():
+            buffer = buffers.get(key)
+            if buffer is None:
+                buffer = PositionRingBuffer(self.window)
+            if buffer.latest_ts is None or ts > buffer.latest_ts:
+                buffer.append(ts, lat, lon)
+            updated[key] = buffer
+        return updated
+
+    def score(self, tracker_id, vehicle_id):
+        """Score co-movement of a tracker and a vehicle over the shared window.
+
+        Returns a dict with the number of tracker samples matched with a vehicle
+        position, the mean separation in meters and the mean heading agreement
+        (cosine, None unless both moved enough), or None when nothing matched.
+        """
+        tracker_buffer = self._trackers.get(tracker_id)
+        vehicle_buffer = self._vehicles.get(vehicle_id)
+        if not tracker_buffer or not vehicle_buffer:
+            return None
+
+        vehicle_samples = vehicle_buffer.samples()
+        pairs = []
+        for ts, lat, lon in tracker_buffer.samples():
+            vehicle_position = _position_at(vehicle_samples, ts)
+            if vehicle_position is not None:
+                pairs.append(((lat, lon), vehicle_position))
+        if not pairs:
+            return None
+
+        separation = sum(_distance(tracker, vehicle) for tracker, vehicle in pairs) / len(pairs)
+
+        agreements = []
+        for (tracker_prev, vehicle_prev), (tracker_cur, vehicle_cur) in zip(pairs, pairs[1:]):
+            tracker_step = _displacement(tracker_prev, tracker_cur)
+            vehicle_step = _displacement(vehicle_prev, vehicle_cur)
+            tracker_norm = math.hypot(*tracker_step)
+            vehicle_norm = math.hypot(*vehicle_step)
+            if tracker_norm < TRAJECTORY_MIN_MOVEMENT or vehicle_norm < TRAJECTORY_MIN_MOVEMENT:
+                continue
+            agreements.append(
+                (tracker_step[0] * vehicle_step[0] + tracker_step[1] * vehicle_step[1]) / (tracker_norm * vehicle_norm)
+            )
+
+        return {
+            'samples': len(pairs),
+            'separation': separation,
+            'heading_agreement': sum(agreements) / len(agreements) if agreements else None,
+        }
+
+    def best_match(self, tracker_id, vehicle_ids):
+        """Return the co-moving vehicle with the smallest mean separation, or None."""
+        best_vehicle_id = None
+        best_separation = float('inf')
+        for vehicle_id in vehicle_ids:
+            score = self.score(tracker_id, vehicle_id)
+            if self._is_co_moving_score(score) and score['separation'] < best_separation:
+                best_separation = score['separation']
+                best_vehicle_id = vehicle_id
+        return best_vehicle_id
+
+    def _is_co_moving_score(self, score):
+        """Return True if a score shows the tracker moving together with the vehicle."""
+        return (
+            score is not None
+            and score['samples'] >= self.min_samples
+            and score['separation'] <= self.radius
+            and score['heading_agreement'] is not None
+            and score['heading_agreement'] >= TRAJECTORY_MIN_HEADING_AGREEMENT
+        )
+
+
+def _position_at(samples, ts):
+    """Return the (lat, lon) of chronological samples at a time, or None if too far from them.
+
+    The position is interpolated linearly between the two surrounding samples,
+    or extrapolated from the two nearest ones if the time is outside the samples
+    by at most TRAJECTORY_MAX_TIME_GAP.
+    """
+    if not samples:
+        return None
+    if ts < samples[0][0] - TRAJECTORY_MAX_TIME_GAP or ts > samples[-1][0] + TRAJECTORY_MAX_TIME_GAP:
+        return None
+    if len(samples) == 1:
+        return samples[0][1], samples[0][2]
+
+    # Pick the segment containing the time, or the first/last one to extrapolate
+    index = 1
+    while index < len(samples) - 1 and samples[index][0] < ts:
+        index += 1
+    prev_ts, prev_lat, prev_lon = samples[index - 1]
+    next_ts, next_lat, next_lon = samples[index]
+    fraction = (ts - prev_ts) / (next_ts - prev_ts)
+    return (
+        prev_lat + (next_lat - prev_lat) * fraction,
+        prev_lon + (next_lon - prev_lon) * fraction,
+    )
+
+
+def _displacement(start, end):
+    """Return the (east, north) displacement in meters between two nearby positions."""
+    mean_lat = math.radians((start[0] + end[0]) / 2)
+    return (
+        (end[1] - start[1]) * METERS_PER_DEGREE * math.cos(mean_lat),
+        (end[0] - start[0]) * METERS_PER_DEGREE,
+    )
+
+
+def _distance(start, end):
+    """Return the approximate distance in meters between two nearby positions."""
+    return math.hypot(*_displacement(start, end))